@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+
+# Nom du modèle sentence-transformers (chargé via PyTorch). Un modèle
+# statique comme sentence-transformers/static-similarity-mrl-multilingual-v1
+# (384 dims également) supprime l'inférence transformer : encodage sub-ms
+# sur CPU, au prix d'une légère perte de qualité à valider sur vos données
+MODEL_NAME = os.environ.get(
+    "EMBEDDING_MODEL",
+    "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+)
+
+# Répertoire du modèle exporté en ONNX (voir README pour la commande d'export)
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "onnx_model")
+
+# Répertoire du modèle quantifié INT8 (voir quantize-onnx-model.py),
+# prioritaire sur le modèle float32 s'il existe
+ONNX_INT8_DIR = os.environ.get("ONNX_INT8_DIR", "onnx_int8")
+
+
+def _load_backend():
+    """Charger le modèle via ONNX Runtime si l'export existe, sinon PyTorch"""
+    for model_dir in (ONNX_INT8_DIR, ONNX_MODEL_DIR):
+        if not os.path.isdir(model_dir):
+            continue
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+
+            ort_model = ORTModelForFeatureExtraction.from_pretrained(
+                model_dir, provider="CPUExecutionProvider"
+            )
+            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+            print(f"Modèle d'embedding chargé via ONNX Runtime ({model_dir})")
+            return ort_model, tokenizer
+        except Exception as e:
+            print(f"Échec du chargement ONNX depuis {model_dir} ({e})")
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # Un thread intra-op par coeur pour les matmuls, un seul pool inter-op :
+    # les valeurs par défaut de torch sous-exploitent largement le CPU
+    torch.set_num_threads(os.cpu_count() or 1)
+    torch.set_num_interop_threads(1)
+
+    model = SentenceTransformer(MODEL_NAME)
+
+    # bfloat16 opt-in : réduit de moitié le trafic mémoire sur les CPU
+    # avec AVX512_BF16 (ex. Sapphire Rapids)
+    if os.environ.get("EMBEDDING_BF16") == "1":
+        model[0].auto_model = model[0].auto_model.to(torch.bfloat16)
+
+    print(f"Modèle d'embedding chargé via PyTorch ({MODEL_NAME})")
+    return model, None
+
+
+_MODEL, _TOKENIZER = _load_backend()
+
+
+def _mean_pooling(token_embeddings, attention_mask):
+    """Moyenne des embeddings de tokens pondérée par le masque d'attention"""
+    mask = attention_mask[..., np.newaxis].astype(np.float32)
+    summed = (token_embeddings * mask).sum(axis=1)
+    counts = np.clip(mask.sum(axis=1), 1e-9, None)
+    return summed / counts
+
+
+# Longueur maximale en tokens : titres + résumés sont courts, tronquer à 256
+# borne le coût quadratique de l'attention sans perte notable de contenu
+MAX_TOKENS = 256
+
+
+def _encode_onnx(texts, batch_size):
+    """Encodage via ONNX Runtime : tokenisation → session.run → mean pooling
+
+    Les textes sont triés par longueur pour que chaque lot regroupe des
+    séquences de taille proche : le padding dynamique (au plus long du lot,
+    pas du modèle) gaspille ainsi un minimum de calcul.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+
+    sorted_vecs = []
+    for start in range(0, len(order), batch_size):
+        batch = [texts[i] for i in order[start:start + batch_size]]
+        inputs = _TOKENIZER(
+            batch,
+            padding="longest",
+            truncation=True,
+            max_length=MAX_TOKENS,
+            return_tensors="np"
+        )
+        outputs = _MODEL(**inputs)
+        pooled = _mean_pooling(outputs.last_hidden_state, inputs["attention_mask"])
+        # Normalisation L2 pour reproduire la similarité cosinus
+        norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        sorted_vecs.append(pooled / norms)
+    sorted_vecs = np.concatenate(sorted_vecs, axis=0)
+
+    # Restaurer l'ordre d'origine des textes
+    vecs = np.empty_like(sorted_vecs)
+    vecs[order] = sorted_vecs
+    return vecs
+
+
+def encode(texts, batch_size=64):
+    """Encoder un texte ou une liste de textes en vecteurs float32 L2-normalisés
+
+    Les vecteurs étant normalisés à l'encodage, le produit scalaire côté ES
+    équivaut à la similarité cosinus, sans calcul de norme par document.
+    """
+    single = isinstance(texts, str)
+    if single:
+        texts = [texts]
+
+    if _TOKENIZER is not None:
+        vecs = _encode_onnx(texts, batch_size)
+    else:
+        import torch
+
+        # inference_mode désactive autograd et le suivi des versions
+        with torch.inference_mode():
+            vecs = _MODEL.encode(
+                texts,
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+
+    vecs = np.asarray(vecs, dtype=np.float32)
+    return vecs[0] if single else vecs
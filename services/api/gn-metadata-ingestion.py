@@ -1,24 +1,37 @@
-import requests
+import functools
+import httpx
+import orjson
+import queue
+import threading
 import time
-import json
 import os
+from pathlib import Path
 from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+from elasticsearch.helpers import bulk
+from elasticsearch.serializer import OrjsonSerializer
+import embedding
 
-# Chargement des configurations
+# Chargement des configurations (mémoïsé : un seul parse par processus)
+@functools.cache
 def load_config():
-    config_dir = "/app/config" if os.path.exists("/app/config") else "../../config"
-    
+    config_dir = Path("/app/config" if os.path.exists("/app/config") else "../../config")
+
     # Configuration principale
-    with open(os.path.join(config_dir, "geonetwork-config.json"), 'r') as f:
-        main_config = json.load(f)
-    
+    main_config = orjson.loads((config_dir / "geonetwork-config.json").read_bytes())
+
     # Configuration de la requête
-    with open(os.path.join(config_dir, "search-query.json"), 'r') as f:
-        query_config = json.load(f)
-    
+    query_config = orjson.loads((config_dir / "search-query.json").read_bytes())
+
     return main_config, query_config
 
+
+def dig(source, path):
+    """Extraire une valeur texte imbriquée selon un chemin pré-découpé"""
+    value = source
+    for part in path:
+        value = value.get(part, {}) if isinstance(value, dict) else ""
+    return value if isinstance(value, str) else ""
+
 # Chargement des configurations
 MAIN_CONFIG, QUERY_CONFIG = load_config()
 
@@ -35,8 +48,23 @@ HEADERS = {
     'Content-Type': 'application/json'
 }
 
-es = Elasticsearch("http://elasticsearch:9200")
-model = SentenceTransformer("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# orjson sérialise nativement les tableaux numpy (vecteurs float32) ;
+# compression gzip : précieuse en bulk, chaque doc porte 384 floats
+es = Elasticsearch(
+    os.environ.get("ES_HOST", "http://elasticsearch:9200"),
+    serializer=OrjsonSerializer(),
+    http_compress=True,
+    request_timeout=30,
+    retry_on_timeout=True,
+    max_retries=3
+)
+
+# Session HTTP réutilisée : keep-alive entre les requêtes de pagination
+SESSION = httpx.Client(
+    timeout=TIMEOUT,
+    headers=HEADERS,
+    limits=httpx.Limits(max_keepalive_connections=10)
+)
 
 def create_index():
     try:
@@ -44,6 +72,8 @@ def create_index():
         response = es.cat.indices(index=ES_INDEX, format="json")
         if response:
             print(f"L'index {ES_INDEX} existe déjà")
+            print("Note : si l'index date d'avant la recherche kNN, supprimez-le")
+            print("pour recréer le mapping (index: true sur le champ embedding)")
             return
     except:
         # L'index n'existe pas, on va le créer
@@ -57,7 +87,14 @@ def create_index():
                     "uuid": {"type": "keyword"},
                     "title": {"type": "text"},
                     "abstract": {"type": "text"},
-                    "embedding": {"type": "dense_vector", "dims": 384}
+                    "embedding": {
+                        "type": "dense_vector",
+                        "dims": 384,
+                        "index": True,
+                        # Vecteurs L2-normalisés à l'encodage : le produit
+                        # scalaire équivaut au cosinus, en moins cher
+                        "similarity": "dot_product"
+                    }
                 }
             }
         )
@@ -65,16 +102,13 @@ def create_index():
     except Exception as e:
         print(f"Erreur lors de la création de l'index: {e}")
 
-def data_ingestion():
-    """
-    Ingestion des métadonnées GeoNetwork avec pagination et délais
-    """
-    print(f"Démarrage de l'ingestion des métadonnées - {MAIN_CONFIG['geonetwork']['name']}...")
+# Sentinelle de fin de flux entre les étages du pipeline
+_DONE = object()
 
-    # Configuration pour être respectueux du serveur
-    total_processed = 0
+def fetch_stage(hits_queue):
+    """Étage 1 : pagination GeoNetwork, pousse les batches de hits bruts"""
     batch_start = 0
-    
+
     while True:
         # Construction de la requête basée sur le template
         body = QUERY_CONFIG["query_template"].copy()
@@ -82,98 +116,164 @@ def data_ingestion():
         body["size"] = BATCH_SIZE
 
         print(f"Requête batch {batch_start//BATCH_SIZE + 1}: récupération de {BATCH_SIZE} enregistrements à partir de {batch_start}...")
-        
+
         try:
-            resp = requests.post(GEONETWORK_URL, json=body, headers=HEADERS, timeout=TIMEOUT)
+            resp = SESSION.post(GEONETWORK_URL, content=orjson.dumps(body))
             resp.raise_for_status()
-            data = resp.json()
-            
-            hits = data.get("hits", {}).get("hits", [])
-            total = data.get("hits", {}).get("total", {})
-            if isinstance(total, dict):
-                total_count = total.get("value", 0)
-            else:
-                total_count = total
-                
-            print(f"Nombre total de résultats disponibles : {total_count}")
-            print(f"Reçu {len(hits)} enregistrements dans ce batch")
-            
-            if not hits:
-                print("Aucun enregistrement supplémentaire trouvé. Fin de l'ingestion.")
-                break
-            
-            # Traitement des enregistrements reçus
-            batch_indexed = 0
-            for i, hit in enumerate(hits):
-                source = hit.get("_source", {})
-                
-                # Extraction des champs basée sur le mapping
-                field_mapping = QUERY_CONFIG["field_mapping"]
-                uuid = source.get(field_mapping["uuid"], "")
-                
-                # Extraction du titre avec gestion des objets imbriqués
-                title_path = field_mapping["title"].split(".")
-                title = source
-                for part in title_path:
-                    title = title.get(part, {}) if isinstance(title, dict) else ""
-                title = title if isinstance(title, str) else ""
-                
-                # Extraction du résumé/abstract avec gestion des objets imbriqués
-                abstract_path = field_mapping["abstract"].split(".")
-                abstract = source
-                for part in abstract_path:
-                    abstract = abstract.get(part, {}) if isinstance(abstract, dict) else ""
-                abstract = abstract if isinstance(abstract, str) else ""
-                
-                text = f"{title} {abstract}".strip()
-                
-                if text and uuid:  # S'assurer qu'on a du contenu et un UUID
-                    print(f"  Indexation {batch_start + i + 1}: {title[:50]}...")
-                    
-                    try:
-                        vec = model.encode(text).tolist()
-                        
-                        clean_doc = {
-                            "uuid": uuid,
-                            "title": title,
-                            "abstract": abstract,
-                            "embedding": vec
-                        }
-                        
-                        es.index(index=ES_INDEX, document=clean_doc)
-                        batch_indexed += 1
-                        total_processed += 1
-                        
-                    except Exception as e:
-                        print(f"  Erreur lors de l'indexation de {uuid}: {e}")
-                        continue
-                else:
-                    print(f"  Ignoré (pas de contenu ou UUID manquant)")
-            
-            print(f"Batch terminé : {batch_indexed} enregistrements indexés")
-            
-            # Vérifier si on a traité tous les enregistrements
-            if batch_start + len(hits) >= total_count:
-                print("Tous les enregistrements ont été traités.")
-                break
-                
-            # Préparer le batch suivant
-            batch_start += BATCH_SIZE
-            
-            # Délai avant la prochaine requête
-            print(f"Pause de {REQUEST_DELAY} secondes...")
-            time.sleep(REQUEST_DELAY)
-            
-        except requests.exceptions.RequestException as e:
+            data = orjson.loads(resp.content)
+        except httpx.HTTPError as e:
             print(f"Erreur lors de la requête HTTP : {e}")
-            print("Arrêt de l'ingestion.")
+            print("Arrêt de la récupération.")
+            break
+
+        hits = data.get("hits", {}).get("hits", [])
+        total = data.get("hits", {}).get("total", {})
+        if isinstance(total, dict):
+            total_count = total.get("value", 0)
+        else:
+            total_count = total
+
+        print(f"Nombre total de résultats disponibles : {total_count}")
+        print(f"Reçu {len(hits)} enregistrements dans ce batch")
+
+        if not hits:
+            print("Aucun enregistrement supplémentaire trouvé. Fin de la récupération.")
+            break
+
+        hits_queue.put(hits)
+
+        # Vérifier si on a récupéré tous les enregistrements
+        if batch_start + len(hits) >= total_count:
+            print("Tous les enregistrements ont été récupérés.")
             break
+
+        # Préparer le batch suivant
+        batch_start += BATCH_SIZE
+
+        # Le délai ne bloque que cet étage : l'encodage et l'indexation
+        # des batches précédents continuent pendant la pause
+        print(f"Pause de {REQUEST_DELAY} secondes...")
+        time.sleep(REQUEST_DELAY)
+
+    hits_queue.put(_DONE)
+
+def encode_stage(hits_queue, docs_queue):
+    """Étage 2 : extraction des champs et encodage par lots"""
+    # Chemins d'extraction pré-découpés une seule fois pour toute l'ingestion
+    field_mapping = QUERY_CONFIG["field_mapping"]
+    uuid_field = field_mapping["uuid"]
+    title_path = field_mapping["title"].split(".")
+    abstract_path = field_mapping["abstract"].split(".")
+
+    while True:
+        hits = hits_queue.get()
+        if hits is _DONE:
+            break
+
+        # Collecte des enregistrements du batch avant encodage
+        records = []
+        for hit in hits:
+            source = hit.get("_source", {})
+
+            # Extraction des champs basée sur le mapping
+            uuid = source.get(uuid_field, "")
+            title = dig(source, title_path)
+            abstract = dig(source, abstract_path)
+
+            text = f"{title} {abstract}".strip()
+
+            if text and uuid:  # S'assurer qu'on a du contenu et un UUID
+                records.append((uuid, title, abstract, text))
+            else:
+                print(f"  Ignoré (pas de contenu ou UUID manquant)")
+
+        if not records:
+            continue
+
+        # Encodage de tout le batch en une seule passe : beaucoup plus
+        # rapide que document par document (tri par longueur et padding
+        # dynamique gérés par sentence-transformers)
+        try:
+            texts = [record[3] for record in records]
+            vecs = embedding.encode(texts, batch_size=64)
         except Exception as e:
-            print(f"Erreur lors du traitement : {e}")
-            print("Arrêt de l'ingestion.")
+            print(f"  Erreur lors de l'encodage du batch: {e}")
+            continue
+
+        docs_queue.put([
+            {
+                "uuid": uuid,
+                "title": title,
+                "abstract": abstract,
+                "embedding": vec
+            }
+            for (uuid, title, abstract, _), vec in zip(records, vecs)
+        ])
+
+    docs_queue.put(_DONE)
+
+def index_stage(docs_queue, totals):
+    """Étage 3 : indexation groupée via l'API _bulk"""
+    while True:
+        docs = docs_queue.get()
+        if docs is _DONE:
             break
-    
-    print(f"Ingestion terminée. {total_processed} enregistrements indexés au total.")
+
+        actions = ({"_index": ES_INDEX, "_source": doc} for doc in docs)
+
+        try:
+            success, errors = bulk(
+                es,
+                actions,
+                chunk_size=500,
+                request_timeout=60,
+                raise_on_error=False
+            )
+            totals["indexed"] += success
+            for error in errors:
+                print(f"  Erreur lors de l'indexation en bloc: {error}")
+            print(f"Batch indexé : {success} enregistrements")
+        except Exception as e:
+            print(f"  Erreur lors de l'indexation du batch: {e}")
+
+def data_ingestion():
+    """
+    Ingestion des métadonnées GeoNetwork en pipeline : la récupération,
+    l'encodage et l'indexation tournent en parallèle au lieu d'alterner
+    """
+    print(f"Démarrage de l'ingestion des métadonnées - {MAIN_CONFIG['geonetwork']['name']}...")
+
+    # Files bornées entre les étages pour la contre-pression
+    hits_queue = queue.Queue(maxsize=2)
+    docs_queue = queue.Queue(maxsize=2)
+    totals = {"indexed": 0}
+
+    # Refresh espacé pendant l'ingestion en masse : moins d'amplification
+    # d'écriture côté ES, restauré (et forcé) à la fin
+    try:
+        es.indices.put_settings(index=ES_INDEX, settings={"index": {"refresh_interval": "30s"}})
+    except Exception as e:
+        print(f"Impossible d'ajuster le refresh_interval: {e}")
+
+    try:
+        encode_thread = threading.Thread(target=encode_stage, args=(hits_queue, docs_queue))
+        index_thread = threading.Thread(target=index_stage, args=(docs_queue, totals))
+        encode_thread.start()
+        index_thread.start()
+
+        # La récupération tourne dans le thread principal
+        fetch_stage(hits_queue)
+
+        encode_thread.join()
+        index_thread.join()
+    finally:
+        try:
+            es.indices.put_settings(index=ES_INDEX, settings={"index": {"refresh_interval": None}})
+            es.indices.refresh(index=ES_INDEX)
+        except Exception as e:
+            print(f"Impossible de restaurer le refresh_interval: {e}")
+
+    print(f"Ingestion terminée. {totals['indexed']} enregistrements indexés au total.")
 
 if __name__ == "__main__":
     print("Ingestion des métadonnées GeoNetwork")
@@ -1,47 +1,98 @@
 from fastapi import FastAPI
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import StreamingResponse
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.serializer import OrjsonSerializer
+import embedding
+import numpy as np
 import uvicorn
-import requests
-import json
+import httpx
+import orjson
 import hashlib
+import os
+from collections import OrderedDict
 from functools import lru_cache
 import time
-from concurrent.futures import ThreadPoolExecutor
 import asyncio
 
 app = FastAPI()
-es = Elasticsearch("http://elasticsearch:9200")
-model = SentenceTransformer("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# orjson sérialise nativement les tableaux numpy : les vecteurs float32
+# partent tels quels vers ES, sans conversion en listes Python.
+# Compression gzip : les payloads avec vecteurs 384 floats fondent de ~3-4x
+es = AsyncElasticsearch(
+    os.environ.get("ES_HOST", "http://elasticsearch:9200"),
+    serializer=OrjsonSerializer(),
+    http_compress=True,
+    request_timeout=30,
+    retry_on_timeout=True,
+    max_retries=3
+)
 
-# Cache en mémoire pour les embeddings fréquents
-embedding_cache = {}
-response_cache = {}
+# Client HTTP réutilisé (keep-alive) pour les appels à Ollama
+ollama_client = httpx.AsyncClient(base_url="http://ollama:11434", timeout=45)
 
-# Pool de threads pour les appels parallèles
-executor = ThreadPoolExecutor(max_workers=4)
+# Cache LRU borné des réponses LLM (l'ancien dict croissait sans limite)
+RESPONSE_CACHE_MAX = 1024
+response_cache = OrderedDict()
 
-@lru_cache(maxsize=100)
+# Cache sémantique : les requêtes paraphrasées partagent leur réponse.
+# Matrice float32 des embeddings de requêtes passées + réponses associées ;
+# les vecteurs étant normalisés, Q @ vec donne directement les cosinus
+SEMANTIC_CACHE_MAX = 10000
+SEMANTIC_SIM_THRESHOLD = 0.97
+semantic_cache = {"vecs": None, "responses": []}
+
+def semantic_cache_lookup(vec):
+    """Réponse dont la requête passée est quasi identique (cosinus > seuil)"""
+    Q = semantic_cache["vecs"]
+    if Q is None or not len(Q):
+        return None
+    sims = Q @ vec  # un seul GEMV, sub-ms même à 10k entrées
+    best = int(np.argmax(sims))
+    if sims[best] >= SEMANTIC_SIM_THRESHOLD:
+        return semantic_cache["responses"][best]
+    return None
+
+def semantic_cache_store(vec, response: str):
+    """Mémorise la réponse, éviction de la plus ancienne au-delà de la limite"""
+    Q = semantic_cache["vecs"]
+    if Q is None:
+        Q = np.empty((0, vec.shape[0]), dtype=np.float32)
+    if len(Q) >= SEMANTIC_CACHE_MAX:
+        Q = Q[1:]
+        semantic_cache["responses"].pop(0)
+    semantic_cache["vecs"] = np.vstack([Q, vec[np.newaxis, :]])
+    semantic_cache["responses"].append(response)
+
+# Identifiant du script Painless stocké pour le repli script_score
+SIMILARITY_SCRIPT_ID = "embedding_sim"
+
+@app.on_event("startup")
+async def register_stored_scripts():
+    """Enregistre le script de similarité côté ES : pré-compilé une fois pour toutes"""
+    try:
+        await es.put_script(
+            id=SIMILARITY_SCRIPT_ID,
+            script={
+                "lang": "painless",
+                # Vecteurs L2-normalisés à l'encodage : dotProduct == cosinus,
+                # sans calcul de norme par document
+                "source": "dotProduct(params.query_vector, 'embedding') + 1.0"
+            }
+        )
+    except Exception as e:
+        print(f"Impossible d'enregistrer le script stocké {SIMILARITY_SCRIPT_ID}: {e}")
+
+@lru_cache(maxsize=4096)
 def get_embedding(query: str):
-    """Cache des embeddings pour éviter la re-génération"""
-    query_hash = hashlib.md5(query.encode()).hexdigest()
-    if query_hash in embedding_cache:
-        return embedding_cache[query_hash]
-    
-    vec = model.encode(query).tolist()
-    embedding_cache[query_hash] = vec
-    return vec
+    """Cache LRU des embeddings (numpy float32, ~10x plus compact qu'une liste)"""
+    return embedding.encode(query)
 
-def search_geocat_optimized(query: str, num_results: int = 20, min_score: float = 0.0):
-    """Recherche sémantique optimisées avec requête hybride et filtrage par score"""
-    print(f"DEBUG: search_geocat_optimized called with num_results={num_results}, min_score={min_score}")
-    vec = get_embedding(query)
-    
-    # Requête hybride : vectorielle + textuelle pour de meilleurs résultats
-    resp = es.search(
+async def search_hybrid_script_score(query: str, vec, num_results: int):
+    """Recherche hybride exacte (script_score) pour les index sans kNN"""
+    return await es.search(
         index="geonetwork",
         size=num_results,
-        _source=["uuid", "title", "abstract", "embedding"],
+        _source=["uuid", "title", "abstract"],  # Pas d'embedding : jamais utilisé côté client
         timeout="10s",
         query={
             "bool": {
@@ -51,7 +102,7 @@ def search_geocat_optimized(query: str, num_results: int = 20, min_score: float
                         "script_score": {
                             "query": {"match_all": {}},
                             "script": {
-                                "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
+                                "id": SIMILARITY_SCRIPT_ID,
                                 "params": {"query_vector": vec}
                             },
                             "boost": 0.7
@@ -70,7 +121,39 @@ def search_geocat_optimized(query: str, num_results: int = 20, min_score: float
             }
         }
     )
-    
+
+async def search_geocat_optimized(query: str, num_results: int = 20, min_score: float = 0.0):
+    """Recherche sémantique optimisées avec requête hybride et filtrage par score"""
+    # Encodage CPU-bound déporté dans un thread pour ne pas bloquer la boucle
+    vec = await asyncio.to_thread(get_embedding, query)
+
+    # Requête hybride : kNN natif (HNSW, sous-linéaire) + textuelle
+    try:
+        resp = await es.search(
+            index="geonetwork",
+            size=num_results,
+            _source=["uuid", "title", "abstract"],  # Pas d'embedding : jamais utilisé côté client
+            timeout="10s",
+            knn={
+                "field": "embedding",
+                "query_vector": vec,
+                "k": num_results,
+                "num_candidates": max(100, 5 * num_results),
+                "boost": 0.7
+            },
+            query={
+                "multi_match": {
+                    "query": query,
+                    "fields": ["title^2", "abstract"],
+                    "type": "best_fields",
+                    "boost": 0.3
+                }
+            }
+        )
+    except Exception:
+        # Index créé avant le mapping kNN : repli sur la similarité exacte
+        resp = await search_hybrid_script_score(query, vec, num_results)
+
     # Retourner les résultats avec les scores de pertinence et filtrage manuel
     results = []
     for hit in resp["hits"]["hits"]:
@@ -80,18 +163,21 @@ def search_geocat_optimized(query: str, num_results: int = 20, min_score: float
             result = hit["_source"].copy()
             result["relevance_score"] = round(score, 3)  # Score de pertinence arrondi
             results.append(result)
-    
-    print(f"DEBUG: Found {len(results)} results with score >= {min_score}")
+
     return results
 
-def generate_response_optimized(query: str, context_docs: list):
-    """Génération optimisées avec cache et timeout adaptatif"""
-    # Cache des réponses basé sur le hash de la query + contexte
-    context_hash = hashlib.md5((query + str([doc['uuid'] for doc in context_docs])).encode()).hexdigest()
-    
-    if context_hash in response_cache:
-        return response_cache[context_hash]
-    
+async def warmup_ollama():
+    """Pré-charge le modèle Ollama (prompt vide) pendant la phase de recherche"""
+    try:
+        await ollama_client.post(
+            "/api/generate",
+            json={"model": "llama3.2:latest", "keep_alive": "30m"}
+        )
+    except Exception:
+        pass
+
+def build_prompt(query: str, context_docs: list):
+    """Construire le prompt de génération à partir des documents trouvés"""
     # Contexte enrichi avec plus d'informations pertinentes
     context = "\n\n".join([
         f"*{doc['title']}*\n"
@@ -99,9 +185,9 @@ def generate_response_optimized(query: str, context_docs: list):
         f"Identifiant : {doc['uuid']}"
         for doc in context_docs[:5]  # Augmenté à 5 documents pour plus de contexte
     ])
-    
+
     # Prompt optimisé pour de meilleurs résultats
-    prompt = f"""Tu es un assistant spécialisé dans les géodonnées. Réponds de manière précise et structurée.
+    return f"""Tu es un assistant spécialisé dans les géodonnées. Réponds de manière précise et structurée.
 
 Informations disponibles :
 {context}
@@ -117,14 +203,37 @@ Instructions :
 
 Réponse :"""
 
+async def generate_response_stream(query: str, context_docs: list):
+    """Génération en flux : émet les tokens au fur et à mesure, avec cache"""
+    # Cache des réponses basé sur le hash de la query + contexte
+    context_hash = hashlib.md5((query + str([doc['uuid'] for doc in context_docs])).encode()).hexdigest()
+
+    if context_hash in response_cache:
+        response_cache.move_to_end(context_hash)
+        yield response_cache[context_hash]
+        return
+
+    # Cache sémantique : une paraphrase d'une requête déjà vue évite
+    # entièrement la génération (l'étape la plus coûteuse du /rag)
+    vec = get_embedding(query)
+    cached = semantic_cache_lookup(vec)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = build_prompt(query, context_docs)
+
+    start_time = time.time()
+    chunks = []
     try:
-        start_time = time.time()
-        response = requests.post(
-            "http://ollama:11434/api/generate",
+        async with ollama_client.stream(
+            "POST",
+            "/api/generate",
             json={
-                "model": "llama3.2:latest", 
+                "model": "llama3.2:latest",
                 "prompt": prompt,
-                "stream": False,
+                "stream": True,
+                "keep_alive": "30m",  # Garde le modèle chargé entre les requêtes
                 "options": {
                     "temperature": 0.2,  # Légèrement plus créatif pour des réponses naturelles
                     "top_p": 0.95,       # Meilleur équilibre créativité/cohérence
@@ -132,24 +241,39 @@ Réponse :"""
                     "num_predict": 400,  # Plus de place pour des réponses détaillées
                     "repeat_penalty": 1.1 # Évite les répétitions
                 }
-            },
-            timeout=45  # Timeout plus court
-        )
-        
-        result = response.json().get("response", "Erreur de génération")
-        generation_time = time.time() - start_time
-        
-        # Cache seulement les réponses rapides (< 30s)
-        if generation_time < 30:
-            response_cache[context_hash] = result
-        
-        return result
-        
+            }
+        ) as response:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                token = orjson.loads(line).get("response", "")
+                if token:
+                    chunks.append(token)
+                    yield token
     except Exception as e:
-        return f"Erreur génération: {e}"
+        yield f"Erreur génération: {e}"
+        return
+
+    result = "".join(chunks)
+    generation_time = time.time() - start_time
+
+    # Cache seulement les réponses rapides (< 30s), éviction LRU
+    if result and generation_time < 30:
+        response_cache[context_hash] = result
+        response_cache.move_to_end(context_hash)
+        if len(response_cache) > RESPONSE_CACHE_MAX:
+            response_cache.popitem(last=False)
+        semantic_cache_store(vec, result)
+
+async def generate_response_optimized(query: str, context_docs: list):
+    """Génération complète : concatène le flux de tokens"""
+    chunks = []
+    async for token in generate_response_stream(query, context_docs):
+        chunks.append(token)
+    return "".join(chunks) or "Erreur de génération"
 
 @app.post("/rag")
-def rag_search(request: dict):
+async def rag_search(request: dict):
     """Endpoint RAG optimisées: recherche + génération avec filtrage par pertinence"""
     query = request.get("query", "")
     num_results = request.get("num_results", 20)  # Par défaut 20 résultats
@@ -159,15 +283,20 @@ def rag_search(request: dict):
         return {"error": "Query required"}
     
     start_time = time.time()
-    
+
+    # Pré-chauffage d'Ollama en parallèle : le modèle se (re)charge pendant
+    # l'embedding et la requête ES au lieu d'attendre la génération
+    warmup_task = asyncio.create_task(warmup_ollama())
+
     # 1. Recherche sémantique optimisée avec filtrage
-    docs = search_geocat_optimized(query, num_results, min_score)
+    docs = await search_geocat_optimized(query, num_results, min_score)
     search_time = time.time() - start_time
-    
+
     # 2. Génération avec contexte optimisée
     try:
         generation_start = time.time()
-        response = generate_response_optimized(query, docs)
+        await warmup_task
+        response = await generate_response_optimized(query, docs)
         generation_time = time.time() - generation_start
         total_time = time.time() - start_time
         
@@ -195,31 +324,86 @@ def rag_search(request: dict):
             }
         }
 
+def sse_event(payload: dict):
+    """Formater un événement server-sent events"""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+@app.post("/rag-stream")
+async def rag_search_stream(request: dict):
+    """Endpoint RAG en flux SSE : les sources d'abord, puis la réponse token par token"""
+    query = request.get("query", "")
+    num_results = request.get("num_results", 20)  # Par défaut 20 résultats
+    min_score = request.get("min_score", 0.0)    # Score minimum de pertinence
+
+    if not query:
+        return {"error": "Query required"}
+
+    async def event_stream():
+        start_time = time.time()
+
+        # Pré-chauffage d'Ollama en parallèle de la recherche
+        warmup_task = asyncio.create_task(warmup_ollama())
+
+        # 1. Recherche sémantique, envoyée dès qu'elle est disponible
+        docs = await search_geocat_optimized(query, num_results, min_score)
+        yield sse_event({
+            "type": "sources",
+            "sources": docs,
+            "search_time": round(time.time() - start_time, 2)
+        })
+
+        # 2. Génération en flux : chaque token part dès qu'Ollama l'émet
+        await warmup_task
+        async for token in generate_response_stream(query, docs):
+            yield sse_event({"type": "token", "token": token})
+
+        yield sse_event({
+            "type": "done",
+            "total_time": round(time.time() - start_time, 2)
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/search")
-def search(query: str, num_results: int = 20, min_score: float = 0.0):
+async def search(query: str, num_results: int = 20, min_score: float = 0.0):
     """Recherche vectorielle rapide avec filtrage par pertinence"""
-    docs = search_geocat_optimized(query, num_results, min_score)
+    docs = await search_geocat_optimized(query, num_results, min_score)
     return {"results": docs}
 
 @app.get("/search-fast")
-def search_fast(query: str):
+async def search_fast(query: str):
     """Recherche ultra-rapide (vectoriel uniquement, pas de génération)"""
-    vec = get_embedding(query)
-    resp = es.search(
-        index="geonetwork",
-        size=20,
-        _source=["uuid", "title", "abstract"],  # Pas d'embedding pour économiser la bande passante
-        timeout="5s",
-        query={
-            "script_score": {
-                "query": {"match_all": {}},
-                "script": {
-                    "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
-                    "params": {"query_vector": vec}
+    vec = await asyncio.to_thread(get_embedding, query)
+    try:
+        resp = await es.search(
+            index="geonetwork",
+            size=20,
+            _source=["uuid", "title", "abstract"],  # Pas d'embedding pour économiser la bande passante
+            timeout="5s",
+            knn={
+                "field": "embedding",
+                "query_vector": vec,
+                "k": 20,
+                "num_candidates": 100
+            }
+        )
+    except Exception:
+        # Index créé avant le mapping kNN : repli sur la similarité exacte
+        resp = await es.search(
+            index="geonetwork",
+            size=20,
+            _source=["uuid", "title", "abstract"],
+            timeout="5s",
+            query={
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {
+                        "id": SIMILARITY_SCRIPT_ID,
+                        "params": {"query_vector": vec}
+                    }
                 }
             }
-        }
-    )
+        )
     return {"results": [hit["_source"] for hit in resp["hits"]["hits"]]}
 
 @app.get("/health")
@@ -228,10 +412,21 @@ def health():
     return {
         "status": "healthy",
         "cache_stats": {
-            "embedding_cache_size": len(embedding_cache),
-            "response_cache_size": len(response_cache)
+            "embedding_cache_size": get_embedding.cache_info().currsize,
+            "response_cache_size": len(response_cache),
+            "semantic_cache_size": len(semantic_cache["responses"])
         }
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Plusieurs workers + uvloop/httptools : chaque worker charge le modèle
+    # une fois au niveau module
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=max(2, (os.cpu_count() or 2) // 2),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )
@@ -0,0 +1,30 @@
+import os
+
+from optimum.onnxruntime import ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+# Répertoires d'entrée (export ONNX, voir README) et de sortie (INT8)
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "onnx_model")
+ONNX_INT8_DIR = os.environ.get("ONNX_INT8_DIR", "onnx_int8")
+
+
+def quantize():
+    """Quantification dynamique INT8 du modèle ONNX (à lancer une fois)"""
+    if not os.path.isdir(ONNX_MODEL_DIR):
+        print(f"Répertoire {ONNX_MODEL_DIR} introuvable. Exportez d'abord le modèle")
+        print("en ONNX avec optimum-cli (voir README).")
+        return
+
+    print(f"Quantification INT8 de {ONNX_MODEL_DIR} vers {ONNX_INT8_DIR}...")
+
+    # Quantification dynamique : pas de jeu de calibration nécessaire,
+    # GEMM int8 via VNNI sur les CPU x86 récents
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer = ORTQuantizer.from_pretrained(ONNX_MODEL_DIR)
+    quantizer.quantize(save_dir=ONNX_INT8_DIR, quantization_config=qconfig)
+
+    print(f"Modèle quantifié enregistré dans {ONNX_INT8_DIR}")
+
+
+if __name__ == "__main__":
+    quantize()
@@ -1,15 +1,17 @@
+import functools
 import gradio as gr
 import requests
-import json
+import orjson
 import os
+from pathlib import Path
 
-# Chargement de la configuration
+# Chargement de la configuration (mémoïsé : un seul parse par processus)
+@functools.cache
 def load_config():
     """Charger la configuration GeoNetwork"""
-    config_path = "/app/config/geonetwork-config.json"
-    if os.path.exists(config_path):
-        with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    config_path = Path("/app/config/geonetwork-config.json")
+    if config_path.exists():
+        return orjson.loads(config_path.read_bytes())
     else:
         # Configuration par défaut
         return {
@@ -23,82 +25,95 @@ CONFIG = load_config()
 GEONETWORK_NAME = CONFIG["geonetwork"]["name"]
 GEONETWORK_BASE_URL = CONFIG["geonetwork"]["base_url"]
 
+def format_sources(sources):
+    """Formatage des sources sous forme de tableau"""
+    sources_data = []
+    for i, source in enumerate(sources[:15], 1):  # Afficher jusqu'à 15 sources
+        score = source.get('relevance_score', 0)
+
+        # Création du lien cliquable générique
+        uuid = source['uuid']
+        # Construction de l'URL basée sur la configuration
+        metadata_url = f"{GEONETWORK_BASE_URL.replace('/geonetwork', '')}/datahub/dataset/{uuid}"
+        link = f'<a href="{metadata_url}" target="_blank" style="color: #1976d2; text-decoration: underline; cursor: pointer;">Consulter la fiche de métadonnées</a>'
+
+        sources_data.append([
+            i,  # Rang
+            source['title'],  # Nom
+            link,  # Lien
+            round(score, 2)  # Score numérique seulement
+        ])
+    return sources_data
+
 def rag_search(query, min_score=0.0):
-    """Fonction de recherche RAG avec indicateurs de statut et filtrage par pertinence"""
+    """Recherche RAG en flux : les sources s'affichent dès la fin de la
+    recherche, puis la réponse se construit token par token"""
     if not query:
-        return "Veuillez saisir une question", gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
-    
+        yield "Veuillez saisir une question", gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
+        return
+
     try:
-        # Phase 1: Recherche sémantique
-        initial_status = "**Recherche en cours...**\n\n"
-        initial_status += "Recherche sémantique dans la base de métadonnées"
-        
         response = requests.post(
-            "http://api:8000/rag",
+            "http://api:8000/rag-stream",
             json={
                 "query": query,
                 "min_score": min_score  # Ajout du filtrage par score
             },
-            timeout=120  # Timeout augmenté à 2 minutes
+            timeout=120,  # Timeout augmenté à 2 minutes
+            stream=True   # SSE : événements consommés au fil de l'eau
         )
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            # Formatage de la réponse
-            answer = result["response"]
-            
-            # Gestion du statut
-            if result.get("status") == "partial_success":
-                answer = answer
-            
-            # Calcul du score maximum des résultats pour adapter le slider
-            max_score = 0.0
-            if result["sources"]:
-                max_score = max(source.get('relevance_score', 0) for source in result["sources"])
-                # Arrondir vers le haut pour avoir une valeur propre
-                max_score = round(max_score + 0.5, 1)
-            
-            # Formatage des sources sous forme de tableau
-            sources_data = []
-            for i, source in enumerate(result["sources"][:15], 1):  # Afficher jusqu'à 15 sources
-                score = source.get('relevance_score', 0)
-                
-                # Création du lien cliquable générique
-                uuid = source['uuid']
-                # Construction de l'URL basée sur la configuration
-                metadata_url = f"{GEONETWORK_BASE_URL.replace('/geonetwork', '')}/datahub/dataset/{uuid}"
-                link = f'<a href="{metadata_url}" target="_blank" style="color: #1976d2; text-decoration: underline; cursor: pointer;">Consulter la fiche de métadonnées</a>'
-                
-                sources_data.append([
-                    i,  # Rang
-                    source['title'],  # Nom
-                    link,  # Lien
-                    round(score, 2)  # Score numérique seulement
-                ])
-            
-            # Message de succès final
-            final_answer = f"{answer}"
-            if min_score > 0:
-                final_answer += f"\n\n*Résultats filtrés avec un score minimum de {min_score}*"
-            
-            # Mise à jour du slider avec le score maximum trouvé
-            slider_update = gr.update(maximum=max(max_score, 1.0), value=min_score)
-            
-            return final_answer, gr.update(visible=True), gr.update(value=sources_data, visible=True), slider_update
-        else:
+
+        if response.status_code != 200:
             error_msg = f"**Erreur HTTP {response.status_code}**"
-            return error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
-            
+            yield error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
+            return
+
+        answer = ""
+        sources_title_update = gr.update(visible=False)
+        sources_update = gr.update(value=[], visible=False)
+        slider_update = gr.update()
+
+        for line in response.iter_lines():
+            if not line or not line.startswith(b"data: "):
+                continue
+            event = orjson.loads(line[len(b"data: "):])
+
+            if event.get("type") == "sources":
+                sources = event.get("sources", [])
+
+                # Calcul du score maximum des résultats pour adapter le slider
+                max_score = 0.0
+                if sources:
+                    max_score = max(source.get('relevance_score', 0) for source in sources)
+                    # Arrondir vers le haut pour avoir une valeur propre
+                    max_score = round(max_score + 0.5, 1)
+
+                sources_title_update = gr.update(visible=True)
+                sources_update = gr.update(value=format_sources(sources), visible=True)
+                slider_update = gr.update(maximum=max(max_score, 1.0), value=min_score)
+
+                yield "**Génération de la réponse...**", sources_title_update, sources_update, slider_update
+
+            elif event.get("type") == "token":
+                answer += event.get("token", "")
+                yield answer, sources_title_update, sources_update, slider_update
+
+        # Message de succès final
+        final_answer = f"{answer}"
+        if min_score > 0:
+            final_answer += f"\n\n*Résultats filtrés avec un score minimum de {min_score}*"
+
+        yield final_answer, sources_title_update, sources_update, slider_update
+
     except requests.exceptions.Timeout:
         error_msg = "**Timeout** - La recherche prend plus de 2 minutes"
-        return error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
+        yield error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
     except requests.exceptions.ConnectionError:
         error_msg = "**Erreur de connexion**"
-        return error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
+        yield error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
     except Exception as e:
         error_msg = f"**Erreur :** {e}"
-        return error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
+        yield error_msg, gr.update(visible=False), gr.update(value=[], visible=False), gr.update()
 
 # Interface Gradio
 with gr.Blocks(title=f"Recherche de géodonnées - {GEONETWORK_NAME}", theme=gr.themes.Soft()) as demo: